@@ -1,39 +1,208 @@
 import sqlite3
-from flask import Flask, g, jsonify, request, render_template, abort
+from flask import Flask, g, jsonify, request, render_template, abort, Response
 from collections import Counter
+import atexit
+import functools
+import json
 import os
+import queue
 import threading
-import time
 import logging
 
+import fastjsonschema
+import orjson
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import numpy as np
+except ImportError:  # optional accelerator for large baskets
+    np = None
+
 # Configuration
 DATABASE = os.path.join(os.path.dirname(__file__), 'coffee.db')
-# Interval (seconds) between automatic DB updates (default: 24 hours)
-BACKGROUND_UPDATE_INTERVAL = int(os.getenv('DB_UPDATE_INTERVAL', 60 * 60 * 24))
+# Largest basket (distinct items) handled by the single CASE-WHEN UPDATE;
+# 3 params per item must stay under SQLite's historical 999-variable limit.
+MAX_CASE_UPDATE_ITEMS = 300
+
+# Basket size above which numpy aggregation beats collections.Counter;
+# below it numpy's array-setup cost dominates.
+NUMPY_COUNT_THRESHOLD = 32
+
+# SQL reused across requests lives at module scope: passing the same string
+# object each time makes sqlite3's per-connection statement cache reliable.
+MENU_SELECT_ALL = 'SELECT id, name, price, inventory FROM menu_items'
+MENU_INSERT_RETURNING = ('INSERT INTO menu_items (name, price, inventory) VALUES (?, ?, ?) '
+                         'RETURNING id, name, price, inventory')
+MENU_DELETE = 'DELETE FROM menu_items WHERE id=?'
+ORDERS_INSERT = 'INSERT INTO orders (customer_name, items, total) VALUES (?, ?, ?)'
+ORDERS_SELECT_PAGE = ('SELECT id, customer_name, items, total, created_at FROM orders '
+                      'ORDER BY created_at DESC LIMIT ? OFFSET ?')
+INVENTORY_DECREMENT = 'UPDATE menu_items SET inventory = inventory - ? WHERE id = ?'
+INVENTORY_ALERT_SELECT = 'SELECT id, name, inventory FROM menu_items WHERE inventory <= ?'
+
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, so jsonify encodes in C."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
+app.json = ORJSONProvider(app)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Request-body validators, compiled once at import. The compiled functions
+# replace the per-field try/except int()/float() casts on the hot paths.
+validate_menu_post = fastjsonschema.compile({
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string', 'minLength': 1},
+        'price': {'type': 'number'},
+        'inventory': {'type': 'integer'},
+    },
+    'required': ['name'],
+})
+validate_menu_put = fastjsonschema.compile({
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'price': {'type': 'number'},
+        'inventory': {'type': 'integer'},
+    },
+})
+validate_order = fastjsonschema.compile({
+    'type': 'object',
+    'properties': {
+        'customer_name': {'type': 'string'},
+        # ids outside SQLite's 64-bit INTEGER range can't exist, and
+        # bounding them here keeps oversized ints out of numpy/binding.
+        'items': {'type': 'array', 'items': {'type': 'integer', 'minimum': 1, 'maximum': 2**63 - 1}},
+    },
+    'required': ['items'],
+})
+
+
+# Small bounded pool of reused connections: opening a sqlite3 connection per
+# request pays for a file open, schema-cache load and PRAGMA setup every time.
+_pool = queue.Queue(maxsize=8)
+
+
+def _new_connection():
+    # check_same_thread=False to allow using the connection safely if a background thread
+    # touches the DB while the app is running. We still prefer to use app.app_context()
+    # for background tasks to get their own connection context.
+    db = sqlite3.connect(DATABASE, check_same_thread=False, cached_statements=256)
+    db.row_factory = sqlite3.Row
+    # WAL lets readers proceed during writes; NORMAL syncing is safe in
+    # WAL mode and avoids an fsync per commit.
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    db.execute('PRAGMA cache_size=-20000')
+    return db
+
+
+# The order path builds SQL whose shape depends only on the number of
+# distinct items; caching the text per size keeps the strings identical
+# across requests so the statement cache can reuse the compiled queries.
+@functools.lru_cache(maxsize=64)
+def _order_req_sql(n):
+    # Totals and availability problems are computed inside SQLite so the
+    # whole basket is validated and priced by one aggregate row.
+    return ('WITH req(id, qty) AS (VALUES ' + ','.join(['(?,?)'] * n) + ') '
+            'SELECT COALESCE(SUM(m.price * r.qty), 0) AS total, '
+            "json_group_array(CASE WHEN m.id IS NULL THEN 'Item id ' || r.id || ' not found' "
+            "ELSE m.name || ' (id ' || r.id || ') only ' || m.inventory || ' left' END) "
+            'FILTER (WHERE m.id IS NULL OR m.inventory < r.qty) AS issues '
+            'FROM req r LEFT JOIN menu_items m ON m.id = r.id')
+
+
+@functools.lru_cache(maxsize=64)
+def _inventory_case_update_sql(n):
+    return ('UPDATE menu_items SET inventory = inventory - CASE id '
+            + ' '.join(['WHEN ? THEN ?'] * n)
+            + ' ELSE 0 END WHERE id IN (' + ','.join('?' * n) + ')')
+
+
+def _count_items(items):
+    """Aggregate a basket of item ids into an {id: qty} mapping.
+
+    Large baskets count in C via numpy.unique; small ones stick with
+    Counter, which wins below the numpy setup cost.
+    """
+    if np is not None and len(items) >= NUMPY_COUNT_THRESHOLD:
+        try:
+            arr = np.asarray(items, dtype=np.int64)
+        except (OverflowError, ValueError):
+            # ids outside int64 range can't go through numpy; Counter
+            # handles arbitrary-precision ints.
+            return Counter(items)
+        ids, qtys = np.unique(arr, return_counts=True)
+        return dict(zip(ids.tolist(), qtys.tolist()))
+    return Counter(items)
+
+
+def _rows_to_dicts(cur):
+    """Materialize a cursor's rows as dicts, resolving column names once.
+
+    dict(row) on sqlite3.Row re-hashes the column names for every row;
+    zipping against the cursor description does that work a single time.
+    """
+    cols = [d[0] for d in cur.description]
+    return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+
+def _close_pool():
+    """Close every pooled connection; per-request teardown only recycles."""
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+
+atexit.register(_close_pool)
+
 
 def get_db():
     """Return a sqlite3 connection unique to the request context (stored in flask.g)."""
     db = getattr(g, '_database', None)
     if db is None:
-        # check_same_thread=False to allow using the connection safely if a background thread
-        # touches the DB while the app is running. We still prefer to use app.app_context()
-        # for background tasks to get their own connection context.
-        db = g._database = sqlite3.connect(DATABASE, check_same_thread=False)
-        db.row_factory = sqlite3.Row
+        try:
+            db = _pool.get_nowait()
+        except queue.Empty:
+            db = _new_connection()
+        g._database = db
     return db
 
 
-def init_db():
+# One-shot init guard: the schema never changes at runtime, so after the
+# first successful init_db() further calls are free.
+_db_initialized = False
+_init_lock = threading.Lock()
+
+
+def init_db(force=False):
     """
     Ensure the database schema and seed data are present.
-    Safe to call repeatedly.
+    Safe to call repeatedly; after the first run it is a no-op unless
+    `force` is set (used by the manual /api/update-db endpoint).
     """
+    global _db_initialized
+    if _db_initialized and not force:
+        return
+    with _init_lock:
+        if _db_initialized and not force:
+            return
+        _run_init_db()
+        _db_initialized = True
+
+
+def _run_init_db():
     logger.info("Running init_db to ensure schema & seed data.")
     db = get_db()
     cursor = db.cursor()
@@ -51,6 +220,11 @@ def init_db():
         total REAL,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );
+    CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders(created_at DESC);
+    CREATE INDEX IF NOT EXISTS idx_menu_inventory ON menu_items(inventory);
+    -- Partial index covering the common low-stock alert thresholds; only
+    -- rows at or below the alert ceiling are indexed, so it stays tiny.
+    CREATE INDEX IF NOT EXISTS idx_menu_low_inventory ON menu_items(inventory) WHERE inventory <= 50;
     ''')
     db.commit()
 
@@ -73,44 +247,74 @@ def init_db():
         db.executemany('INSERT INTO menu_items (name, price, inventory) VALUES (?, ?, ?)', items)
         db.commit()
 
+    # refresh planner statistics so the partial index gets picked up
+    db.execute('ANALYZE menu_items')
+    db.commit()
+
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        # Never recycle a connection mid-transaction: a handler that
+        # raised between a DML statement and its commit would otherwise
+        # leak its half-finished write into the next request's commit.
+        if db.in_transaction:
+            try:
+                db.rollback()
+            except sqlite3.Error:
+                db.close()
+                return
+        try:
+            _pool.put_nowait(db)
+        except queue.Full:
+            db.close()
 
 
 @app.route('/')
 def index():
-    # Ensure DB exists/seeded before serving the UI
-    init_db()
     return render_template('index.html')
 
 
+# Cached serialized bytes for GET /api/menu; the menu only changes on
+# writes, so reads between writes skip SQL and JSON encoding entirely.
+_menu_cache = None
+_menu_cache_lock = threading.Lock()
+
+
+def _invalidate_menu_cache():
+    global _menu_cache
+    with _menu_cache_lock:
+        _menu_cache = None
+
+
 @app.route('/api/menu', methods=['GET', 'POST'])
 def api_menu():
+    global _menu_cache
     db = get_db()
     if request.method == 'GET':
-        rows = db.execute('SELECT id, name, price, inventory FROM menu_items').fetchall()
-        return jsonify([dict(r) for r in rows])
+        cached = _menu_cache
+        if cached is not None:
+            return Response(cached, mimetype='application/json')
+        cur = db.execute(MENU_SELECT_ALL)
+        payload = orjson.dumps(_rows_to_dicts(cur))
+        with _menu_cache_lock:
+            _menu_cache = payload
+        return Response(payload, mimetype='application/json')
     else:
         data = request.get_json() or {}
-        name = data.get('name')
-        try:
-            price = float(data.get('price', 0))
-        except (TypeError, ValueError):
-            return jsonify({'error': 'invalid price'}), 400
         try:
-            inventory = int(data.get('inventory', 0))
-        except (TypeError, ValueError):
-            return jsonify({'error': 'invalid inventory'}), 400
-        if not name:
-            return jsonify({'error': 'name required'}), 400
-        cur = db.execute('INSERT INTO menu_items (name, price, inventory) VALUES (?, ?, ?)', (name, price, inventory))
+            validate_menu_post(data)
+        except fastjsonschema.JsonSchemaException as e:
+            return jsonify({'error': e.message}), 400
+        name = data['name']
+        price = float(data.get('price', 0))
+        inventory = int(data.get('inventory', 0))
+        # RETURNING (SQLite >= 3.35) fuses the INSERT and the read-back
+        # into one statement.
+        row = db.execute(MENU_INSERT_RETURNING, (name, price, inventory)).fetchone()
         db.commit()
-        item_id = cur.lastrowid
-        row = db.execute('SELECT id, name, price, inventory FROM menu_items WHERE id=?', (item_id,)).fetchone()
+        _invalidate_menu_cache()
         return jsonify(dict(row)), 201
 
 
@@ -119,17 +323,13 @@ def api_menu_item(item_id):
     db = get_db()
     if request.method == 'PUT':
         data = request.get_json() or {}
-        name = data.get('name')
-        try:
-            price = data.get('price')
-            price = float(price) if price is not None else None
-        except (TypeError, ValueError):
-            return jsonify({'error': 'invalid price'}), 400
         try:
-            inventory = data.get('inventory')
-            inventory = int(inventory) if inventory is not None else None
-        except (TypeError, ValueError):
-            return jsonify({'error': 'invalid inventory'}), 400
+            validate_menu_put(data)
+        except fastjsonschema.JsonSchemaException as e:
+            return jsonify({'error': e.message}), 400
+        name = data.get('name')
+        price = data.get('price')
+        inventory = data.get('inventory')
 
         # build update
         parts = []
@@ -146,18 +346,20 @@ def api_menu_item(item_id):
         if not parts:
             return jsonify({'error': 'no fields to update'}), 400
         params.append(item_id)
-        db.execute(f"UPDATE menu_items SET {', '.join(parts)} WHERE id = ?", params)
+        row = db.execute(
+            f"UPDATE menu_items SET {', '.join(parts)} WHERE id = ? RETURNING id, name, price, inventory",
+            params).fetchone()
         db.commit()
-        row = db.execute('SELECT id, name, price, inventory FROM menu_items WHERE id=?', (item_id,)).fetchone()
-        if not row:
+        if row is None:
             return jsonify({'error': 'not found'}), 404
+        _invalidate_menu_cache()
         return jsonify(dict(row))
     else:
-        cur = db.execute('SELECT id FROM menu_items WHERE id=?', (item_id,)).fetchone()
-        if not cur:
-            return jsonify({'error': 'not found'}), 404
-        db.execute('DELETE FROM menu_items WHERE id=?', (item_id,))
+        cur = db.execute(MENU_DELETE, (item_id,))
         db.commit()
+        if cur.rowcount == 0:
+            return jsonify({'error': 'not found'}), 404
+        _invalidate_menu_cache()
         return jsonify({'status': 'deleted'})
 
 
@@ -166,52 +368,60 @@ def api_orders():
     db = get_db()
     if request.method == 'POST':
         data = request.get_json() or {}
+        try:
+            validate_order(data)
+        except fastjsonschema.JsonSchemaException as e:
+            return jsonify({'error': e.message}), 400
         name = data.get('customer_name', 'Guest')
-        items = data.get('items', [])
-        if not isinstance(items, list):
-            return jsonify({'error': 'items must be a list of menu item ids'}), 400
+        items = data['items']
         if not items:
-            total = 0.0
-            db.execute('INSERT INTO orders (customer_name, items, total) VALUES (?, ?, ?)', (name, '', total))
-            db.commit()
-            return jsonify({'status': 'ok', 'total': total}), 201
-
-        # Normalize item ids to ints and validate
-        try:
-            items = [int(i) for i in items]
-        except (TypeError, ValueError):
-            return jsonify({'error': 'items must be a list of integers (menu item ids)'}), 400
+            return jsonify({'error': 'items required'}), 400
 
-        counts = Counter(items)
+        counts = _count_items(items)
         keys = list(counts.keys())
-        placeholders = ','.join('?' * len(keys))
-        cur = db.execute(f'SELECT id, name, price, inventory FROM menu_items WHERE id IN ({placeholders})', keys)
-        rows = cur.fetchall()
-        prices = {row['id']: row['price'] for row in rows}
-        inventory = {row['id']: row['inventory'] for row in rows}
-        names = {row['id']: row['name'] for row in rows}
-
-        insufficient = []
-        for item_id, qty in counts.items():
-            inv = inventory.get(item_id)
-            if inv is None:
-                insufficient.append(f'Item id {item_id} not found')
-            elif inv < qty:
-                insufficient.append(f"{names.get(item_id,'Item')} (id {item_id}) only {inv} left")
-        if insufficient:
-            return jsonify({'error': 'insufficient_inventory', 'details': insufficient}), 400
 
-        total = 0.0
+        # Join the requested (id, qty) pairs against menu_items in one
+        # statement that both validates availability and sums price*qty,
+        # so the total arrives precomputed in a single aggregate row. The
+        # same interleaved (id, qty) list also feeds the CASE-WHEN UPDATE.
+        item_params = []
         for item_id, qty in counts.items():
-            total += prices.get(item_id, 0) * qty
-            db.execute('UPDATE menu_items SET inventory = inventory - ? WHERE id = ?', (qty, item_id))
+            item_params.extend((item_id, qty))
+        result = db.execute(_order_req_sql(len(counts)), item_params).fetchone()
 
-        db.execute('INSERT INTO orders (customer_name, items, total) VALUES (?, ?, ?)', (name, ','.join(map(str, items)), total))
-        db.commit()
+        insufficient = orjson.loads(result['issues'])
+        if insufficient:
+            return jsonify({'error': 'insufficient_inventory', 'details': insufficient}), 400
+        total = result['total']
+        # One transaction (and one fsync) for the whole order: the context
+        # manager issues BEGIN/COMMIT around the UPDATE(s) and the INSERT.
+        with db:
+            if len(counts) <= MAX_CASE_UPDATE_ITEMS:
+                # Decrement all inventories in a single statement instead of
+                # one UPDATE per distinct item.
+                db.execute(_inventory_case_update_sql(len(counts)), item_params + keys)
+            else:
+                # Huge baskets would exceed SQLite's bound-variable limit in
+                # the CASE form; executemany still binds in C with a single
+                # prepared statement.
+                db.executemany(INVENTORY_DECREMENT,
+                               [(qty, iid) for iid, qty in counts.items()])
+            # Compact JSON is the canonical form for the items column:
+            # json.dumps runs its loop in C (faster than ','.join(map(str, …))
+            # for long baskets) and stays machine-parseable for reporting.
+            db.execute(ORDERS_INSERT, (name, json.dumps(items, separators=(',', ':')), total))
+        _invalidate_menu_cache()
         return jsonify({'status': 'ok', 'total': total}), 201
     else:
-        rows = db.execute('SELECT id, customer_name, items, total, created_at FROM orders ORDER BY created_at DESC').fetchall()
-        return jsonify([dict(r) for r in rows])
+        try:
+            limit = min(int(request.args.get('limit', 50)), 500)
+            offset = int(request.args.get('offset', 0))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'invalid limit/offset'}), 400
+        if limit < 0 or offset < 0:
+            return jsonify({'error': 'invalid limit/offset'}), 400
+        cur = db.execute(ORDERS_SELECT_PAGE, (limit, offset))
+        return jsonify(_rows_to_dicts(cur))
 
 
 # Inventory alert endpoint
@@ -223,8 +433,8 @@ def inventory_alert():
         threshold = int(threshold_str)
     except (TypeError, ValueError):
         return jsonify({'error': 'invalid threshold'}), 400
-    rows = db.execute('SELECT id, name, inventory FROM menu_items WHERE inventory <= ?', (threshold,)).fetchall()
-    return jsonify([dict(r) for r in rows])
+    cur = db.execute(INVENTORY_ALERT_SELECT, (threshold,))
+    return jsonify(_rows_to_dicts(cur))
 
 
 @app.route('/api/update-db', methods=['POST'])
@@ -232,42 +442,17 @@ def trigger_update_db():
     """Manual endpoint to trigger DB init/seed. Useful for webhooks or admin actions."""
     try:
         with app.app_context():
-            init_db()
+            init_db(force=True)
         return jsonify({'status': 'ok'}), 200
     except Exception as e:
         logger.exception("Error running manual DB update")
         return jsonify({'error': str(e)}), 500
 
 
-def _periodic_db_updater(interval_seconds):
-    """Background thread job that runs init_db() every interval_seconds with app context."""
-    logger.info("Started periodic DB updater thread (interval=%s seconds).", interval_seconds)
-    while True:
-        try:
-            with app.app_context():
-                init_db()
-        except Exception:
-            logger.exception("Periodic DB updater failed")
-        time.sleep(interval_seconds)
-
-
-def start_periodic_db_updates(interval_seconds=BACKGROUND_UPDATE_INTERVAL):
-    """
-    Start a daemon thread to periodically call init_db.
-    This function should only be called once (typically on startup).
-    """
-    thread = threading.Thread(target=_periodic_db_updater, args=(interval_seconds,))
-    thread.daemon = True
-    thread.start()
-    return thread
-
-
 if __name__ == '__main__':
     # Initialize DB now
     with app.app_context():
         init_db()
-    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' or not app.debug:
-        start_periodic_db_updates()
 
     # Run server
     app.run(debug=True, port=5000)
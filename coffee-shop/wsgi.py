@@ -0,0 +1,16 @@
+"""WSGI entry point for running under a production server.
+
+The Werkzeug dev server started by ``python app.py`` is single-threaded
+and meant for development only. In production run e.g.:
+
+    gunicorn -w 4 --threads 2 wsgi:application
+
+Each worker process gets its own connection pool; WAL mode keeps readers
+from blocking on writers across workers.
+"""
+from app import app, init_db
+
+with app.app_context():
+    init_db()
+
+application = app